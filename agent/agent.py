@@ -3,6 +3,8 @@ import time
 import serviceManager
 import hosting
 
+TICK_INTERVAL = 0.2 # Seconds between service manager ticks
+
 manager = serviceManager.ServiceManager()
 
 manager.load_service_configs("services.json")
@@ -15,7 +17,12 @@ for service in manager.get_services():
   print(f"Service: {service.name} (ID: {service.id}) - Status: {service.is_running()}")
   # service.stop_service()
 
+# Sleep until a socket is ready or the next manager tick is due
+next_manager_tick = 0.0
 while(True):
-  manager.tick()
-  hosting.tick()
-  time.sleep(0.2)
\ No newline at end of file
+  now = time.monotonic()
+  if(now >= next_manager_tick):
+    manager.tick()
+    next_manager_tick = now + TICK_INTERVAL
+  hosting.wait(next_manager_tick - time.monotonic())
+  hosting.tick()
\ No newline at end of file
@@ -9,8 +9,8 @@ SOCKET_TMP_PATH = "/tmp/procpilot.sock"
 # Connect and send
 client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 client.connect(SOCKET_TMP_PATH)
-client.send(Packet.create(Packet.Type.RAW, "PRINT", b"Hello world! lol").to_bytes())
-client.send(Packet.create(Packet.Type.RAW, "PRINT", b"Hello world again! lol").to_bytes())
+client.sendall(Packet.create(Packet.Type.RAW, "PRINT", b"Hello world! lol").to_bytes())
+client.sendall(Packet.create(Packet.Type.RAW, "PRINT", b"Hello world again! lol").to_bytes())
 client.close()
 
 print("Sent raw packet")
\ No newline at end of file
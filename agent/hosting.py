@@ -1,8 +1,31 @@
 import socket
+import selectors
 import os
 import time
 import json
-from typing import Any
+import struct
+from collections import deque
+from typing import Any, Callable
+
+# orjson is much faster, but optional. Differences from the stdlib json module when it's installed:
+# - decoding: ints wider than 64 bits come back as (lossy) floats
+# - encoding: ints wider than 64 bits raise ValueError, NaN / Infinity become null, output is compact
+try:
+  import orjson
+  def _json_loads(raw_bytes: bytes) -> Any:
+    try: return orjson.loads(raw_bytes)
+    except orjson.JSONDecodeError: # Let json decide, it also accepts NaN / Infinity and a UTF-8 BOM
+      return json.loads(raw_bytes)
+  def _json_dumps(data) -> bytes:
+    try: return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS) # Allow int etc. keys like json.dumps
+    except TypeError as e: # orjson.JSONEncodeError, e.g. unsupported type or int over 64 bits
+      raise ValueError(f"Data is not JSON serializable: {e}")
+except ImportError:
+  _json_loads = json.loads
+  def _json_dumps(data) -> bytes:
+    try: return json.dumps(data).encode('utf-8')
+    except TypeError as e:
+      raise ValueError(f"Data is not JSON serializable: {e}")
 
 import serviceManager
 
@@ -10,16 +33,29 @@ import serviceManager
 # Path for local ProcPilot client-agent communication
 SOCKET_TMP_PATH = "/tmp/procpilot.sock"
 DEFAULT_CLIENT_TIMEOUT = 10.0
+BUFFER_COMPACT_SIZE = 64 * 1024 # Consumed bytes allowed at the front of a recv buffer before compacting
+MAX_POOLED_BUFFER_SIZE = 64 * 1024 # Size of pooled send buffers, sends that don't fit use a one-off buffer
+MAX_SEND_POOL_SIZE = 16
+RECV_SIZE = 4096
+MAX_SEND_QUEUE_SIZE = 16 * 1024 * 1024 # Unsent bytes a connection may queue before it's dropped
 
 server_socket: socket.socket = None
+selector: selectors.BaseSelector = None # Wakes the main loop when the server or a connection is ready
+ready_events: list[tuple[selectors.SelectorKey, int]] = [] # Sockets (and their events) reported by the last wait()
 
 managerConnection:'Connection' = None
 connections: list['Connection'] = []
+_send_pool: deque[bytearray] = deque(maxlen=MAX_SEND_POOL_SIZE) # Reusable send buffers
+_recv_view = memoryview(bytearray(RECV_SIZE)) # Shared fixed recv buffer, only used within fill_buffer
 
 manager:serviceManager.ServiceManager = None
 
 # Format: [TYPE (1)] [SUBTYPE (8, padded)] [LENGTH (4)] [DATA (length)]
+_HEADER = struct.Struct(">B8sI") # struct pads / truncates the subtype to 8 bytes
+
 class Packet():
+  __slots__ = ("type", "sub_type", "_subtype_bytes", "bytes", "full_size", "json")
+
   class Type:
     RAW = 1
     JSON = 2
@@ -33,53 +69,47 @@ class Packet():
 
     self.type = packet_type
     self.sub_type = packet_sub_type
+    self._subtype_bytes = packet_sub_type.encode('utf-8')[:8].ljust(8, b'\x00') # Header form, sub_type is never changed
     self.bytes = raw_bytes
     self.full_size = 13 + len(raw_bytes) # Size of entire packet
 
     self.json = None
     if(self.type == Packet.Type.JSON):
-      try: self.json = json.loads(raw_bytes.decode('utf-8'))
-      except json.JSONDecodeError as e:
+      try: self.json = _json_loads(raw_bytes)
+      except ValueError as e: # Covers json / orjson decode errors and bad utf-8
         raise ValueError(f"Invalid JSON payload: {e}")
 
   @staticmethod
   def get_length(length_bytes: bytes) -> int: # Expects buffer length 4
     if(len(length_bytes) < 4): return -1 # Not enough data for type and length
-    length = (length_bytes[0] << 24) | (length_bytes[1] << 16) | (length_bytes[2] << 8) | length_bytes[3]
-    return length
+    return int.from_bytes(length_bytes[:4], 'big')
   @staticmethod
-  def to_length(length: int) -> bytes:
-    length_bytes = bytes([
-      (length >> 24) & 0xFF,  # Most significant byte
-      (length >> 16) & 0xFF,
-      (length >> 8) & 0xFF,
-      length & 0xFF           # Least significant byte
-    ])
-    return length_bytes
-  @staticmethod
-  def check_complete(buffer: bytes) -> bool:
+  def check_complete(buffer: bytes|memoryview) -> bool:
     if(len(buffer) < 13): return False # Not enough data for type, subtype and length
     length = (Packet.get_length(buffer[9:13]))
     return len(buffer) >= 13 + length  # Check if we have header + full payload
   @staticmethod
-  def from_buffer(buffer: bytes) -> 'Packet':
-    if(not Packet.check_complete(buffer)): raise ValueError("Buffer does not contain a complete packet")
-    packet_type = buffer[0] # 1 is raw, 2 is JSON, 3+ is not used yet, so ignored
-    try: packet_sub_type = buffer[1:9].rstrip(b'\x00').decode('utf-8')
+  def from_buffer(buffer: bytes|memoryview) -> 'Packet':
+    """Parse a packet from the front of buffer, the payload is copied out so buffer can be reused."""
+    if(len(buffer) < 13): raise ValueError("Buffer does not contain a complete packet")
+    # 1 is raw, 2 is JSON, 3+ is not used yet, so ignored
+    packet_type, sub_type_bytes, length = _HEADER.unpack_from(buffer) # Whole header in one call
+    if(len(buffer) < 13 + length): raise ValueError("Buffer does not contain a complete packet")
+    try: packet_sub_type = sub_type_bytes.rstrip(b'\x00').decode('utf-8')
     except UnicodeDecodeError: raise ValueError("Invalid sub-type encoding")
-    length = Packet.get_length(buffer[9:13])
-    payload = buffer[13:13+length]
+    payload = bytes(buffer[13:13+length])
     return Packet(packet_type, packet_sub_type, payload)
   @staticmethod
   def create(packet_type:int, packet_sub_type:str, data:bytes|str|dict) -> 'Packet':
     """
     Create a packet.
     Pass in raw bytes, a string, or a dictionary (for JSON).
+    Raises ValueError for bad data, including dictionaries that can't be serialized.
     """
 
     raw_bytes = b""
     if(packet_type == Packet.Type.JSON):
-      if isinstance(data, dict): raw_bytes = json.dumps(data).encode('utf-8')
+      if isinstance(data, dict): raw_bytes = _json_dumps(data)
       else: raise ValueError("For JSON packets, data must be a dictionary")
     elif(packet_type == Packet.Type.RAW):
       if isinstance(data, bytes): raw_bytes = data
@@ -90,38 +120,46 @@ class Packet():
     return Packet(packet_type, packet_sub_type, raw_bytes)
 
   def to_bytes(self) -> bytes:
-    # 1. TYPE (1 byte)
-    packet_bytes = bytes([self.type])
-    #2. SUBTYPE (8 bytes, with padding)
-    subtype_bytes = self.sub_type.encode('utf-8')[:8].ljust(8, b'\x00')
-    packet_bytes += subtype_bytes
-    # 3. LENGTH (4 bytes, big-endian)
-    length = len(self.bytes)
-    packet_bytes += Packet.to_length(length)
-    # 4. DATA (use self.bytes)
-    packet_bytes += self.bytes
-    return packet_bytes
+    header = _HEADER.pack(self.type, self._subtype_bytes, len(self.bytes))
+    return header + self.bytes
+
+  def to_bytes_into(self, buf: bytearray, offset: int = 0) -> int:
+    """
+    Like to_bytes, but writes the packet into buf at offset without allocating.
+    buf must have room for full_size bytes, returns the offset just past the packet.
+    """
+    _HEADER.pack_into(buf, offset, self.type, self._subtype_bytes, len(self.bytes))
+    end = offset + self.full_size
+    buf[offset + 13:end] = self.bytes
+    return end
 
 class Connection():
+  __slots__ = ("socket", "buffer", "read_pos", "send_queue", "address", "last_active", "closed")
+
   def __init__(self, sock: socket.socket):
     self.socket = sock
-    self.buffer = b""
+    self.buffer = bytearray()
+    self.read_pos = 0 # Start of unparsed data in buffer
+    self.send_queue = bytearray() # Data the socket couldn't take yet, flushed when it becomes writable
     try: self.address = sock.getpeername()
     except (OSError, AttributeError): self.address = "unix_socket"
     self.last_active = time.time()
     self.closed = False
-  
+    if selector is not None: selector.register(sock, selectors.EVENT_READ, self)
+
   def close(self):
+    if(self.closed): return
+    if selector is not None: selector.unregister(self.socket)
     self.socket.close()
     self.closed = True
 
   # Recv waiting buffer
-  def fill_buffer(self):
+  def fill_buffer(self, now:float|None = None):
     try:
-      data = self.socket.recv(4096)
-      if data:
-        self.buffer += data
-        self.last_active = time.time()
+      received = self.socket.recv_into(_recv_view)
+      if received:
+        self.buffer += _recv_view[:received]
+        self.last_active = now if now is not None else time.time()
       else:
         self.close()
     except BlockingIOError: pass  # No data available right now
@@ -130,19 +168,91 @@ class Connection():
       self.close()
   
   def send_packet(self, packet:Packet):
+    self.send_packets([packet])
+
+  def send_packets(self, packets:list[Packet]):
+    """Sends packets back to back, coalesced into one buffer so they usually leave in a single send."""
+    if(self.closed):
+      raise ConnectionError("Not connected to socket - cannot send packet")
+    total_size = sum(packet.full_size for packet in packets)
+    if(total_size > MAX_POOLED_BUFFER_SIZE): buf = bytearray(total_size) # Too big for pooled buffers, dropped after sending
+    else: buf = _send_pool.popleft() if _send_pool else bytearray(MAX_POOLED_BUFFER_SIZE)
+    try:
+      end = 0
+      for packet in packets: end = packet.to_bytes_into(buf, end)
+      with memoryview(buf)[:end] as view: # Pooled buffers keep their size, only send the written part
+        self.__send_all(view)
+    finally:
+      if(len(buf) <= MAX_POOLED_BUFFER_SIZE): _send_pool.append(buf)
+
+  def send_log_end(self, log:serviceManager.Log, num_bytes:int, backwards_offset:int = 0, respect_current_session:bool = True):
+    """
+    Sends the end of a log as a RAW LOG_END packet.
+    The payload goes from file to socket without passing through Python, unless the socket is full and it has to be queued.
+    """
     if(self.closed):
       raise ConnectionError("Not connected to socket - cannot send packet")
-    packet_bytes = packet.to_bytes()
-    self.socket.send(packet_bytes)
+    start_pos, size = log.end_range(num_bytes, backwards_offset, respect_current_session)
+    self.__send_all(_HEADER.pack(Packet.Type.RAW, b"LOG_END", size))
+    sent = 0
+    if(not self.send_queue): sent = log.splice_to(self.socket.fileno(), start_pos, size) # Can't jump ahead of queued data
+    if(sent < size): # Socket is full, queue the rest like any other send
+      rest = log.read_range(start_pos + sent, size - sent)
+      if(len(rest) != size - sent):
+        self.close() # File shrank, header promised more data than there is, the stream can't be recovered
+        raise ConnectionError(f"Failed to send log to {self.address}")
+      self.__send_all(rest)
+
+  # send() on a non-blocking socket may write only part of the data, queue the rest instead of waiting
+  def __send_all(self, data:bytes|bytearray|memoryview):
+    if(self.send_queue): # Stay behind already queued data
+      self.__queue(data)
+      return
+    try: sent = self.socket.send(data)
+    except BlockingIOError: sent = 0
+    if(sent < len(data)):
+      with memoryview(data) as view: self.__queue(view[sent:])
+
+  def __queue(self, data:bytes|bytearray|memoryview):
+    if(len(self.send_queue) + len(data) > MAX_SEND_QUEUE_SIZE):
+      self.close()
+      raise ConnectionError(f"Send queue full for {self.address}")
+    if(not self.send_queue and selector is not None): # Wake up when the socket can take more
+      selector.modify(self.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+    self.send_queue += data
+
+  def flush(self, now:float|None = None):
+    """Sends queued data, call when the selector reports the socket as writable."""
+    if(not self.send_queue): return
+    try: sent = self.socket.send(self.send_queue)
+    except BlockingIOError: return
+    except OSError as e:
+      print(f"Error sending to {self.address}: {e}")
+      self.close()
+      return
+    if sent: self.last_active = now if now is not None else time.time() # A stalled reader still times out
+    del self.send_queue[:sent]
+    if(not self.send_queue and selector is not None):
+      selector.modify(self.socket, selectors.EVENT_READ, self)
 
   def get_next_packet(self) -> Packet|None:
-    if not Packet.check_complete(self.buffer): return None
-    packet = Packet.from_buffer(self.buffer)
-    self.buffer = self.buffer[packet.full_size:]
+    # Parse through a view and advance read_pos instead of re-slicing the buffer for every packet
+    with memoryview(self.buffer)[self.read_pos:] as pending:
+      if not Packet.check_complete(pending): return None
+      packet = Packet.from_buffer(pending)
+    self.read_pos += packet.full_size
+
+    if(self.read_pos == len(self.buffer)):
+      self.buffer.clear()
+      self.read_pos = 0
+    elif(self.read_pos > BUFFER_COMPACT_SIZE):
+      del self.buffer[:self.read_pos]
+      self.read_pos = 0
     return packet
 
-  def check_timeout(self, timeout:float=DEFAULT_CLIENT_TIMEOUT) -> bool:
-    if(time.time() - self.last_active > timeout):
+  def check_timeout(self, timeout:float=DEFAULT_CLIENT_TIMEOUT, now:float|None = None) -> bool:
+    if now is None: now = time.time()
+    if(now - self.last_active > timeout):
       print("Client timed out")
       self.close()
       return False
@@ -159,10 +269,12 @@ def create_unix_socket_server(name=SOCKET_TMP_PATH):
   return server
 
 def initialize_server_socket():
-  global server_socket
+  global server_socket, selector
   if server_socket is None:
     server_socket = create_unix_socket_server()
     server_socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ)
     print(f"Server listening on {server_socket.getsockname()}")
   else:
     print("Server socket already initialized.")
@@ -172,42 +284,88 @@ def set_service_manager(s_manager:serviceManager.ServiceManager):
   manager = s_manager
 
 def kill_server_socket():
-  global server_socket
+  global server_socket, selector
   if server_socket is not None:
+    selector.close()
+    selector = None
     server_socket.close()
     server_socket = None
     print("Server socket closed.")
   else:
     print("Server socket was not initialized.")
 
-# Should be called periodically to handle incoming connections and data
-def tick():
-  try:
-    # Accept new connections if any
-    conn, _ = server_socket.accept()
+def wait(timeout:float) -> bool:
+  """
+  Blocks until the server socket or a connection becomes ready, or timeout seconds pass.
+  Ready sockets are kept for the next tick() so it only touches sockets with work.
+  Returns True if any socket is ready.
+  """
+  global ready_events
+  timeout = max(0.0, timeout)
+  if selector is None:
+    time.sleep(timeout)
+    return False
+  ready_events = selector.select(timeout)
+  return bool(ready_events)
+
+def accept_connections(now:float|None = None):
+  """Accepts every pending connection on the server socket."""
+  while True:
+    try: conn, _ = server_socket.accept()
+    except BlockingIOError: return # Backlog drained
     conn.setblocking(False)
     c = Connection(conn)
     connections.append(c)
     print("Accepted new connection.")
-  except BlockingIOError:
-    pass  # No incoming connection this tick
+    # Clients usually send right after connecting, read now so those packets are handled this tick
+    c.fill_buffer(now)
 
-  # Remove connections marked as closed
-  connections[:] = [c for c in connections if not c.closed]
+# Packet handlers, keyed by packet sub-type
+def _h_close(c:Connection, packet:Packet):
+  c.close()
 
-  for c in connections:
-    if(not c.check_timeout()): continue
+def _h_print(c:Connection, packet:Packet):
+  print(packet.bytes.decode())
+
+def _h_print_j(c:Connection, packet:Packet):
+  print(packet.json["message"])
+
+_HANDLERS: dict[str, Callable[[Connection, Packet], None]] = {
+  "CLOSE": _h_close,
+  "PRINT": _h_print,
+  "PRINT_J": _h_print_j,
+}
+
+# Should be called after wait() returns to handle incoming connections and data
+def tick():
+  global ready_events
+  events, ready_events = ready_events, []
+  now = time.time() # One timestamp for the whole tick
+
+  # Only accept / send / recv on sockets the selector reported as ready
+  for key, mask in events:
+    if key.fileobj is server_socket:
+      accept_connections(now)
+      continue
+    c:Connection = key.data
+    if(not c.closed and mask & selectors.EVENT_WRITE): c.flush(now)
+    if(not c.closed and mask & selectors.EVENT_READ): c.fill_buffer(now)
 
-    # Get new data and try to recv a packet
-    c.fill_buffer()
-    packet:Packet = c.get_next_packet()
-    if(not packet): continue
+  # Remove connections marked as closed, in place since usually nothing closed
+  for i in range(len(connections) - 1, -1, -1):
+    if connections[i].closed: connections.pop(i)
+
+  for c in connections:
+    if(not c.check_timeout(now=now)): continue
 
-    if(packet.sub_type == "CLOSE"):
-      c.close()
+    # Handle every complete packet, the selector won't wake us for already buffered data
+    while(not c.closed):
+      packet:Packet = c.get_next_packet()
+      if(not packet): break
 
-    if(packet.sub_type == "PRINT"):
-      print(packet.bytes.decode())
-    
-    if(packet.sub_type == "PRINT_J"):
-      print(packet.json["message"])
+      handler = _HANDLERS.get(packet.sub_type)
+      if(not handler): continue
+      try: handler(c, packet)
+      except OSError as e: # Includes ConnectionError from sends, only drop this connection
+        print(f"Error handling {packet.sub_type} from {c.address}: {e}")
+        c.close()
@@ -1,21 +1,39 @@
 from __future__ import annotations
 
 from io import TextIOWrapper
+import ctypes
+import datetime
+import functools
 import json
 import subprocess
 import time
 import os
 import re
+import struct
 
 from typing import Optional, Union
 
 LOGFILE_FOLDER = "."
 MAX_LOG_READ_SIZE = 1024 * 992 # 992KB max read size (just under 1MB packet limit)
 
+MARKER_PREFIX = "--- [PROCPILOT]"
+_MARKER_PREFIX_BYTES = MARKER_PREFIX.encode('utf-8')
+# Example marker: --- [PROCPILOT] MARKER_NAME [tags] (YYYY-MM-DD HH:MM:SS) ---
+_MARKER_RE = re.compile(r"--- \[PROCPILOT\] (.+?) \[(.*?)\] \(([^)]+)\) ---")
+
+@functools.lru_cache(maxsize=256)
+def _parse_marker_time(timestamp_str: str) -> int:
+  """Parse a marker timestamp (local time), cached since markers written together share timestamps"""
+  return int(datetime.datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S").timestamp())
+
 # Tracks a specific log file
 class Log():
+  __slots__ = ("file_path", "last_pos", "max_read_size", "old_sessions", "current_session",
+               "current_pos", "current_line", "current_line_start", "_read_fd", "_read_file_id")
 
   class Marker():
+    __slots__ = ("name", "tags", "timestamp", "pos", "line_num")
+
     def __init__(self, name: str, timestamp: int, tags: list[str], pos: int, line_num: int):
       self.name = name
       self.tags = tags or []
@@ -38,21 +56,22 @@ class Log():
     def from_line(line: str) -> Log.Marker|None:
       """Create new marker from log line"""
       if(not line): return None
-      if(not line.startswith("--- [PROCPILOT]")): return None
+      if(not line.startswith(MARKER_PREFIX)): return None
 
-      # Example marker: --- [PROCPILOT] MARKER_NAME [tags] (YYYY-MM-DD HH:MM:SS) ---
-      match = re.search(r"--- \[PROCPILOT\] (.+?) \[(.*?)\] \(([^)]+)\) ---", line)
+      match = _MARKER_RE.match(line)
       if not match: return None
 
       marker_name = match.group(1)
       marker_tags = match.group(2).split(",") if match.group(2) else []
 
-      try: marked_time = int(time.mktime(time.strptime(match.group(3), "%Y-%m-%d %H:%M:%S")))
-      except Exception: return None
+      try: marked_time = _parse_marker_time(match.group(3))
+      except ValueError: return None
 
       return Log.Marker(marker_name, marked_time, marker_tags, 0, 0)
 
   class SessionInfo():
+    __slots__ = ("start_pos", "end_pos", "markers", "start_time", "end_time")
+
     def __init__(self):
       self.start_pos:int = None
       self.end_pos:int = None
@@ -72,6 +91,14 @@ class Log():
     self.current_line: int = 0
     self.current_line_start: int = 0
 
+    # Read-only fd kept open between reads, with the (device, inode) it was opened on to detect a replaced file
+    self._read_fd: int | None = None
+    self._read_file_id: tuple[int, int] | None = None
+    self.__ensure_exists()
+
+  def __del__(self):
+    if self._read_fd is not None: os.close(self._read_fd)
+
   def __end_session(self, end_pos: int, end_time: float|None = None):
     """Ends the current session."""
     if self.current_session:
@@ -105,18 +132,32 @@ class Log():
 
   def handle_new_lines(self):
     """Handles new, unread, lines in log file, new sessions, markers, etc."""
-    with self.__open() as f:
-      f.seek(self.current_pos) # Move to last read position
-      while True:
-        line_start_pos = f.tell() # Temp line start position
-        line = f.readline()
-        if not line: break
+    fd, _ = self.__read_fd()
+    while True:
+      data = os.pread(fd, self.max_read_size, self.current_pos) # Read from last read position
+      if not data: break
+      at_eof = len(data) < self.max_read_size
+      # A line longer than a chunk, keep reading until it ends
+      chunk = data
+      while(not at_eof and b"\n" not in chunk):
+        chunk = os.pread(fd, self.max_read_size, self.current_pos + len(data))
+        data += chunk
+        at_eof = len(chunk) < self.max_read_size
+
+      lines = data.splitlines(keepends=True)
+      # The chunk may end mid-line (or between \r and \n), leave that line for the next chunk
+      if(not at_eof and not lines[-1].endswith(b"\n")):
+        lines.pop()
+
+      for line in lines:
         self.current_line += 1
-        self.current_pos = f.tell()
-        self.current_line_start = line_start_pos # Fullfill
-        self.__handle_line(line)
+        self.current_line_start = self.current_pos
+        self.current_pos += len(line)
+        # Only decode possible markers, plain output lines are skipped as bytes
+        if line.startswith(_MARKER_PREFIX_BYTES):
+          self.__handle_line(line.decode('utf-8', errors='replace'))
 
-  def __open(self, mode:str = "r") -> TextIOWrapper:
+  def __ensure_exists(self):
     # Ensure the directory exists before opening the file
     dir_path = os.path.dirname(self.file_path)
     if dir_path and not os.path.exists(dir_path):
@@ -124,7 +165,36 @@ class Log():
     # Ensure the file exists
     if not os.path.exists(self.file_path):
       open(self.file_path, "a").close()
-    return open(self.file_path, mode)
+
+  def __open(self, mode:str = "r") -> TextIOWrapper:
+    try: return open(self.file_path, mode)
+    except FileNotFoundError: # Log was removed since __init__
+      self.__ensure_exists()
+      return open(self.file_path, mode)
+
+  def __read_fd(self) -> tuple[int, int]:
+    """
+    Returns the persistent read-only fd and the current file size
+    The fd is reopened if the log file was replaced (e.g. rotated or deleted), scanning and sessions then restart from the top.
+    """
+    try: st = os.stat(self.file_path)
+    except FileNotFoundError:
+      self.__ensure_exists()
+      st = os.stat(self.file_path)
+
+    file_id = (st.st_dev, st.st_ino)
+    if(self._read_fd is not None and file_id == self._read_file_id): return self._read_fd, st.st_size
+
+    if self._read_fd is not None: # File was replaced, positions and sessions belonged to the old one
+      os.close(self._read_fd)
+      self.current_pos = 0
+      self.current_line = 0
+      self.current_line_start = 0
+      self.current_session = None
+      self.old_sessions = []
+    self._read_fd = os.open(self.file_path, os.O_RDONLY | os.O_CLOEXEC)
+    self._read_file_id = file_id
+    return self._read_fd, st.st_size
 
   def read_after(self, position:int) -> tuple[str, int]:
     """
@@ -144,26 +214,54 @@ class Log():
     If respect_current_session is True, the read position will be capped at the current session's start position
     returns the read content and the end position.
     """
+    start_pos, read_size = self.end_range(num_bytes, backwards_offset, respect_current_session)
+    if read_size == 0: return "", start_pos
     with self.__open() as f:
-      f.seek(0, os.SEEK_END)
-      file_size = f.tell()
-      if file_size == 0: return "", 0
-      # Calculate actual read size respecting max_read_size
-      actual_read_size = min(num_bytes, self.max_read_size)
-
-      # Calculate start position with backwards_offset (cap to 0)
-      start_pos = file_size - actual_read_size - backwards_offset
-      start_pos = max(0, start_pos)
-
-      # If respecting session, don't overread into old sessions
-      if(respect_current_session and self.current_session and self.current_session.start_pos != None):
-        start_pos = max(start_pos, self.current_session.start_pos)
-        actual_read_size = min(actual_read_size, file_size - start_pos)
-
       f.seek(start_pos)
-      data = f.read(actual_read_size)
+      data = f.read(read_size)
       return data, f.tell()
 
+  def end_range(self, num_bytes: int, backwards_offset: int = 0, respect_current_session: bool = True) -> tuple[int, int]:
+    """
+    Works out which part of the log file read_end would return
+    Returns the start position and size in bytes.
+    Checks the file through the persistent fd, which may reset scan state if the file was replaced.
+    """
+    _, file_size = self.__read_fd()
+    if file_size == 0: return 0, 0
+    # Calculate actual read size respecting max_read_size
+    actual_read_size = min(num_bytes, self.max_read_size)
+
+    # Calculate start position with backwards_offset (cap to 0)
+    start_pos = file_size - actual_read_size - backwards_offset
+    start_pos = max(0, start_pos)
+
+    # If respecting session, don't overread into old sessions
+    if(respect_current_session and self.current_session and self.current_session.start_pos != None):
+      start_pos = max(start_pos, self.current_session.start_pos)
+    actual_read_size = min(actual_read_size, file_size - start_pos)
+    return start_pos, actual_read_size
+
+  def splice_to(self, out_fd: int, start_pos: int, size: int) -> int:
+    """
+    Copies up to size bytes from start_pos straight to out_fd (e.g. a socket) with sendfile, without reading them into Python
+    Never waits, stops early when a non-blocking out_fd is full or the file ends
+    Returns the number of bytes sent.
+    """
+    fd, _ = self.__read_fd()
+    sent = 0
+    while sent < size:
+      try: n = os.sendfile(out_fd, fd, start_pos + sent, size - sent)
+      except BlockingIOError: break
+      if n == 0: break # Reached end of file
+      sent += n
+    return sent
+
+  def read_range(self, start_pos: int, size: int) -> bytes:
+    """Reads up to size raw bytes from start_pos, short if the file ends first."""
+    fd, _ = self.__read_fd()
+    return os.pread(fd, size, start_pos)
+
   def write_marker(self, marker:Log.Marker):
     """implant_timestamp - Looks for 'timestamp' in string and replaces it with the current timestamp"""
     m_str = marker.to_string()
@@ -182,6 +280,9 @@ class Log():
     return f"{LOGFILE_FOLDER}/ProcPilot_log_{id}.log"
 
 class Service():
+  __slots__ = ("id", "name", "name_standardized", "start_directory", "startup_command", "shutdown_command",
+               "auto_start", "tmux_session_name", "log_file_path", "log", "last_log_pos", "_session_pid")
+
   def __init__(self, id: str, name: str):
     self.id: str = id
     self.name: str = name
@@ -199,9 +300,7 @@ class Service():
 
     self.last_log_pos = 0
 
-    self._last_is_running_check_stale_timeout_ = 0.5
-    self._last_is_running_check_ = 0
-    self._last_is_running_check_result_ = False
+    self._session_pid: int | None = None # PID of the tmux pane process, probed with kill(pid, 0)
 
   @staticmethod
   def standardize_name(name: str) -> str:
@@ -229,15 +328,29 @@ class Service():
       "auto_start": self.auto_start
     }
 
-  # Caches results for faster checks, stales quickly
+  # Probes the cached pane PID, only asks tmux when the PID is unknown or force_refresh is set
   def is_running(self, force_refresh=False) -> bool:
-    now = time.time()
-    if(force_refresh or (now - self._last_is_running_check_ > self._last_is_running_check_stale_timeout_)):
-      result = subprocess.run(["tmux", "has-session", "-t", self.tmux_session_name],
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-      self._last_is_running_check_result_ = (result.returncode == 0)
-      self._last_is_running_check_ = now
-    return self._last_is_running_check_result_
+    if(not force_refresh and self._session_pid is not None):
+      try: os.kill(self._session_pid, 0)
+      except ProcessLookupError:
+        self._session_pid = None
+        return False
+      except PermissionError: pass # Process exists but is owned by someone else
+      return True
+
+    result = subprocess.run(["tmux", "has-session", "-t", self.tmux_session_name],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if(result.returncode != 0):
+      self._session_pid = None
+      return False
+    if(self._session_pid is None): self.__capture_session_pid()
+    return True
+
+  def __capture_session_pid(self):
+    result = subprocess.run(["tmux", "display-message", "-p", "-t", self.tmux_session_name, "#{pane_pid}"],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try: self._session_pid = int(result.stdout.strip())
+    except ValueError: self._session_pid = None
 
   def start_service(self) -> bool:
     if(self.is_running(True)): return False # Service already running
@@ -255,12 +368,14 @@ class Service():
       "tmux", "pipe-pane", "-t", self.tmux_session_name,
       "-o", f"cat >> {self.log_file_path}"
     ], stdout=subprocess.DEVNULL)
+    self.__capture_session_pid()
     return True
   
   def stop_service(self) -> bool:
     if not self.is_running(True): return False # Service is not running
     subprocess.run(["tmux", "kill-session", "-t", self.tmux_session_name],
                    stdout=subprocess.DEVNULL)
+    self._session_pid = None
     self.log.write_stop_marker()
     return True
   
@@ -273,9 +388,92 @@ class Service():
     subprocess.run(["tmux", "send-keys", "-t", self.tmux_session_name, byte])
     return True
 
+# Tracks which log files changed, so only those get re-scanned
+class LogWatcher():
+  # inotify constants, see <sys/inotify.h>
+  IN_MODIFY = 0x00000002
+  IN_DELETE_SELF = 0x00000400
+  IN_MOVE_SELF = 0x00000800
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  _EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+
+  def __init__(self):
+    self.fd: int | None = None # None when inotify is unavailable, every log then counts as changed
+    self._paths: dict[str, str] = {}
+    self._keys_by_wd: dict[int, str] = {}
+    self._wds_by_key: dict[str, int] = {}
+    self._pending: set[str] = set() # Keys to report on the next changed() call regardless of events
+
+    try:
+      self._libc = ctypes.CDLL(None, use_errno=True)
+      self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+      self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+      fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError): return # Not Linux
+    if fd >= 0: self.fd = fd
+
+  def __del__(self):
+    if self.fd is not None: os.close(self.fd)
+
+  def watch(self, key: str, path: str):
+    """Start watching path, reported as key. It counts as changed until the next changed() call."""
+    self._paths[key] = path
+    self._pending.add(key)
+    self.__add_watch(key)
+
+  def clear(self):
+    for wd in self._keys_by_wd:
+      self._libc.inotify_rm_watch(self.fd, wd)
+    self._paths.clear()
+    self._keys_by_wd.clear()
+    self._wds_by_key.clear()
+    self._pending.clear()
+
+  def changed(self) -> set[str]:
+    """Returns the keys of watched files modified since the last call."""
+    if self.fd is None: return set(self._paths)
+
+    changed, self._pending = self._pending, set()
+    for key in changed: # Retry watches lost to a missing / replaced file
+      if key not in self._wds_by_key: self.__add_watch(key)
+
+    while True:
+      try: data = os.read(self.fd, 4096)
+      except BlockingIOError: break
+      offset = 0
+      while offset < len(data):
+        wd, mask, _, name_len = LogWatcher._EVENT.unpack_from(data, offset)
+        offset += LogWatcher._EVENT.size + name_len
+        if mask & LogWatcher.IN_Q_OVERFLOW: # Events were dropped, rescan everything
+          changed.update(self._paths)
+          continue
+        key = self._keys_by_wd.get(wd)
+        if key is None: continue
+        changed.add(key)
+        if mask & (LogWatcher.IN_DELETE_SELF | LogWatcher.IN_MOVE_SELF | LogWatcher.IN_IGNORED):
+          # The watch follows the old file, watch the path again on the next call
+          if not mask & LogWatcher.IN_IGNORED: self._libc.inotify_rm_watch(self.fd, wd)
+          del self._keys_by_wd[wd]
+          del self._wds_by_key[key]
+          self._pending.add(key)
+    return changed
+
+  def __add_watch(self, key: str):
+    if self.fd is None: return
+    mask = LogWatcher.IN_MODIFY | LogWatcher.IN_DELETE_SELF | LogWatcher.IN_MOVE_SELF
+    wd = self._libc.inotify_add_watch(self.fd, self._paths[key].encode(), mask)
+    if wd < 0:
+      self._pending.add(key) # Can't watch yet (e.g. file missing), keep re-scanning until we can
+      return
+    self._keys_by_wd[wd] = key
+    self._wds_by_key[key] = wd
+
 class ServiceManager():
   def __init__(self):
     self.services: dict[str, Service] = {}
+    self._by_name: dict[str, Service] = {} # Name index for get_service_by_name
+    self._log_watcher = LogWatcher() # Only logs reported here are re-scanned each tick
 
   def save_service_configs(self, config_file: str) -> bool:
     services_data = [service.to_json() for service in self.services.values()]
@@ -285,6 +483,8 @@ class ServiceManager():
 
   def load_service_configs(self, config_file: str) -> bool:
     self.services.clear()
+    self._by_name.clear()
+    self._log_watcher.clear()
     with open(config_file, "r") as f:
       try: services_data:list[dict] = json.load(f)
       except json.JSONDecodeError: return False
@@ -292,6 +492,8 @@ class ServiceManager():
         try:
           service:Service = Service.from_json(service_dict)
           self.services[service.id] = service
+          self._by_name.setdefault(service.name, service) # First service wins on duplicate names
+          self._log_watcher.watch(service.id, service.log_file_path)
         except ValueError:
           print(f"Invalid service configuration: {service_dict}")
           continue
@@ -307,14 +509,13 @@ class ServiceManager():
     return self.services.get(id, None)
 
   def get_service_by_name(self, name:str) -> Service|None:
-    for service in self.services.values():
-      if service.name == name: return service
-    return None
+    return self._by_name.get(name, None)
   
   def tick(self):
+    changed_logs = self._log_watcher.changed()
     for service in self.get_services():
-      service.log.handle_new_lines()
-      if(service.auto_start and not service.is_running(True)):
+      if service.id in changed_logs: service.log.handle_new_lines()
+      if(service.auto_start and not service.is_running()):
         service.start_service()
         print(f"Auto-started service: {service.name}")
 